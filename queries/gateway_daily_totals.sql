@@ -0,0 +1,17 @@
+SELECT 
+  vpc.account_id,
+  'egress' as flow_direction,
+  nat.nat_gateway_id,
+  nat.availability_zone,
+  ROUND(SUM(vpc.bytes) / 1024.0 / 1024.0 / 1024.0, 4) as usage_gb,
+  ROUND((SUM(vpc.bytes) / 1024.0 / 1024.0 / 1024.0) * 0.045, 4) as cost_usd
+FROM "nat_gateway_analysis_vpc_flow_logs"."vpc_flow_logs" vpc
+JOIN "nat_gateway_analysis_vpc_flow_logs"."nat_gateway_metadata" nat 
+  ON vpc.interface_id = nat.interface_id
+WHERE vpc.flow_direction = 'egress'
+  AND vpc.srcaddr = nat.private_ip
+  AND vpc.year = ?
+  AND vpc.month = ?
+  AND vpc.day = ?
+GROUP BY vpc.account_id, nat.nat_gateway_id, nat.availability_zone
+ORDER BY usage_gb DESC
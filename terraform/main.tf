@@ -58,7 +58,10 @@ module "lambda_athena_query" {
   private_ip_query                = file("${path.module}/../queries/private_ip_traffic.sql")
   ingress_private_ip_query        = file("${path.module}/../queries/ingress_private_ip_traffic.sql")
   egress_public_ip_query          = file("${path.module}/../queries/egress_public_ip_traffic.sql")
+  gateway_totals_query            = file("${path.module}/../queries/gateway_daily_totals.sql")
   datahub_api_url                 = var.datahub_api_url
   datahub_api_key                 = var.datahub_api_key
   datahub_customer_context        = var.datahub_customer_context
+  fanout_targets                  = var.fanout_targets
+  fanout_max_workers              = var.fanout_max_workers
 }
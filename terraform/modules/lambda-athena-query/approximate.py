@@ -0,0 +1,147 @@
+"""
+Fast approximate mode for the NAT Gateway cost queries.
+
+Athena bills by bytes scanned, and TABLESAMPLE BERNOULLI still reads every
+row, so the approximation samples whole hour partitions instead. Each query
+is rewritten to aggregate a random subset of the day's 24 hour partitions
+per group and hour, and an outer query scales those per-hour values back up
+to a full-day estimate, with a 95% confidence interval computed from their
+spread (simple random sampling of hours without replacement). Ranking and
+LIMIT are applied to the estimates in Athena, so only the top rows are
+returned.
+"""
+
+import random
+import re
+
+HOURS_PER_DAY = 24
+
+# 95% two-sided normal quantile
+Z_95 = 1.96
+
+# Columns that are estimated (scaled up) rather than used as group keys
+METRIC_COLUMNS = ['usage_gb', 'cost_usd']
+
+QUERY_PATTERN = re.compile(
+    r'^\s*SELECT\s+(?P<columns>.*?)\s+FROM\s+(?P<source>.*?)\s+GROUP\s+BY\s+(?P<group_by>.*?)'
+    r'(?P<order_by>\s+ORDER\s+BY\s+.*?)?(?P<limit>\s+LIMIT\s+\d+)?\s*;?\s*$',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def choose_sample_hours(sample_hours):
+    """Pick a random, sorted subset of the day's hour partitions"""
+
+    if not 2 <= sample_hours <= HOURS_PER_DAY:
+        raise Exception(f'sampleHours must be between 2 and {HOURS_PER_DAY}, got {sample_hours}')
+
+    return sorted(random.sample(range(HOURS_PER_DAY), sample_hours))
+
+
+def split_columns(columns):
+    """Split a SELECT list on its top-level commas"""
+
+    parts = []
+    depth = 0
+    current = ''
+    for char in columns:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    parts.append(current.strip())
+    return parts
+
+
+def column_name(column):
+    """Return the output name of a SELECT list item"""
+
+    match = re.search(r'\s+AS\s+(\w+)$', column, re.IGNORECASE) or re.search(r'(\w+)$', column)
+    if not match:
+        raise Exception(f'Query cannot be approximated: unnamed column {column!r}')
+    return match.group(1)
+
+
+def rewrite_query(query, hours):
+    """
+    Rewrite a daily query to estimate its results from the given hour partitions.
+
+    The original query becomes an `hourly` subquery restricted to the sampled
+    hours and grouped by hour as well, with its metrics left unrounded. The
+    outer query sums each group's hours, scales the sum by 24/n and adds a
+    <metric>_ci95 column per metric holding the 95% CI half-width, then
+    applies the original ORDER BY / LIMIT to the estimates.
+    """
+
+    match = QUERY_PATTERN.match(query)
+    if not match:
+        raise Exception('Query cannot be approximated: expected SELECT ... FROM ... GROUP BY ...')
+
+    source, count = re.subn(
+        r'(\bvpc\.day\s*=\s*\?)',
+        rf"\1\n  AND vpc.hour IN ({', '.join(str(hour) for hour in hours)})",
+        match.group('source'),
+        count=1,
+        flags=re.IGNORECASE
+    )
+    if count != 1:
+        raise Exception('Query cannot be approximated: no "vpc.day = ?" filter')
+
+    inner_columns = []
+    outer_columns = []
+    group_keys = []
+    metrics = []
+    for column in split_columns(match.group('columns')):
+        name = column_name(column)
+        if name.lower() in METRIC_COLUMNS:
+            expression = re.sub(r'\s+AS\s+\w+$', '', column, flags=re.IGNORECASE)
+            # Round only the scaled-up estimate, not the per-hour values
+            rounded = re.match(r'^ROUND\s*\((.*),\s*\d+\s*\)$', expression, re.IGNORECASE | re.DOTALL)
+            if rounded:
+                expression = rounded.group(1)
+            inner_columns.append(f'{expression} AS hour_{name}')
+            outer_columns.append(f'ROUND(SUM(hour_{name}) * {HOURS_PER_DAY} / {len(hours)}.0, 4) AS {name}')
+            metrics.append(name)
+        else:
+            inner_columns.append(column)
+            outer_columns.append(name)
+            group_keys.append(name)
+
+    if not metrics:
+        raise Exception(f'Query cannot be approximated: no {" or ".join(METRIC_COLUMNS)} column')
+
+    # Sampled hours without traffic for a group count as zero, so the sum of
+    # squared deviations over all n sampled hours is SUM(x^2) - SUM(x)^2 / n
+    sample_size = len(hours)
+    finite_population_correction = 1 - sample_size / HOURS_PER_DAY
+    for name in metrics:
+        squared_deviations = (
+            f'GREATEST(SUM(hour_{name} * hour_{name}) - SUM(hour_{name}) * SUM(hour_{name}) / {sample_size}.0, 0)'
+        )
+        outer_columns.append(
+            f'ROUND({Z_95} * {HOURS_PER_DAY} * SQRT({finite_population_correction} * {squared_deviations} '
+            f'/ ({sample_size - 1}.0 * {sample_size}.0)), 4) AS {name}_ci95'
+        )
+
+    indent = ',\n  '
+    rewritten = (
+        f"WITH hourly AS (\n"
+        f"SELECT\n  {indent.join(inner_columns)}\n"
+        f"FROM {source}\n"
+        f"GROUP BY {match.group('group_by').strip()}, vpc.hour\n"
+        f")\n"
+        f"SELECT\n  {indent.join(outer_columns)}\n"
+        f"FROM hourly\n"
+        f"GROUP BY {', '.join(group_keys)}"
+    )
+    if match.group('order_by'):
+        rewritten += '\n' + match.group('order_by').strip()
+    if match.group('limit'):
+        rewritten += '\n' + match.group('limit').strip()
+
+    return rewritten
@@ -27,6 +27,29 @@ pip install -r "${SCRIPT_DIR}/requirements.txt" -t "$PACKAGE_DIR" --quiet
 # Copy Lambda function
 echo "Copying Lambda function..."
 cp "${SCRIPT_DIR}/lambda_function.py" "$PACKAGE_DIR/"
+cp "${SCRIPT_DIR}/history_store.py" "$PACKAGE_DIR/"
+cp "${SCRIPT_DIR}/approximate.py" "$PACKAGE_DIR/"
+
+# Package the SQL queries (environment variables are limited to 4 KB)
+# Terraform passes the module's query variables in the environment; a manual
+# build falls back to the repository's queries/ directory
+echo "Writing queries..."
+QUERIES_SOURCE_DIR="${SCRIPT_DIR}/../../../queries"
+mkdir -p "$PACKAGE_DIR/queries"
+write_query() {
+    local query="$1"
+    local file="$2"
+    if [ -n "$query" ]; then
+        printf '%s' "$query" > "$PACKAGE_DIR/queries/$file"
+    else
+        cp "${QUERIES_SOURCE_DIR}/$file" "$PACKAGE_DIR/queries/$file"
+    fi
+}
+write_query "${PUBLIC_IP_QUERY:-}" public_ip_traffic.sql
+write_query "${PRIVATE_IP_QUERY:-}" private_ip_traffic.sql
+write_query "${INGRESS_PRIVATE_IP_QUERY:-}" ingress_private_ip_traffic.sql
+write_query "${EGRESS_PUBLIC_IP_QUERY:-}" egress_public_ip_traffic.sql
+write_query "${GATEWAY_TOTALS_QUERY:-}" gateway_daily_totals.sql
 
 # List package contents
 echo "Package contents:"
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Local history store of daily NAT Gateway cost aggregates.
+
+Every Lambda run appends the rows returned by the Athena queries to a compact
+SQLite database indexed by date, NAT gateway, source and destination IP.
+The database is kept in S3 so that range, trend and month-to-date questions
+can be answered locally in milliseconds without re-scanning the flow logs.
+
+Usage:
+    python history_store.py --db history.sqlite range 2026-02-01 2026-02-28
+    python history_store.py --s3-bucket my-bucket trend nat-0123456789abcdef0
+    python history_store.py --s3-bucket my-bucket mtd --as-of 2026-02-15
+"""
+
+import os
+import sqlite3
+import sys
+from datetime import date as date_cls
+from datetime import datetime
+
+DEFAULT_HISTORY_KEY = 'history/nat_cost_history.sqlite'
+
+# The DoitHub queries only keep their top 30 rows per day, so daily totals
+# come from the untruncated per-gateway query (queries/gateway_daily_totals.sql).
+TOTALS_QUERY_TYPE = 'gateway_totals'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_aggregates (
+    date              TEXT NOT NULL,
+    query_type        TEXT NOT NULL,
+    account_id        TEXT NOT NULL DEFAULT '',
+    nat_gateway_id    TEXT NOT NULL DEFAULT '',
+    availability_zone TEXT NOT NULL DEFAULT '',
+    flow_direction    TEXT NOT NULL DEFAULT '',
+    source_ip         TEXT NOT NULL DEFAULT '',
+    destination_ip    TEXT NOT NULL DEFAULT '',
+    usage_gb          REAL NOT NULL DEFAULT 0,
+    cost_usd          REAL NOT NULL DEFAULT 0,
+    recorded_at       TEXT NOT NULL,
+    target            TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_daily_date ON daily_aggregates (date, query_type);
+CREATE INDEX IF NOT EXISTS idx_daily_gateway ON daily_aggregates (nat_gateway_id, date);
+CREATE INDEX IF NOT EXISTS idx_daily_source ON daily_aggregates (source_ip, date);
+CREATE INDEX IF NOT EXISTS idx_daily_destination ON daily_aggregates (destination_ip, date);
+"""
+
+
+def normalize_date(year, month, day):
+    """Return an ISO (YYYY-MM-DD) date string from Athena partition values"""
+    return date_cls(int(year), int(month), int(day)).isoformat()
+
+
+def connect(db_path):
+    """Open (and create if needed) the history database"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+
+    # Stores created before fan-out targets were recorded
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(daily_aggregates)')]
+    if 'target' not in columns:
+        with conn:
+            conn.execute("ALTER TABLE daily_aggregates ADD COLUMN target TEXT NOT NULL DEFAULT ''")
+    return conn
+
+
+def download_history(s3_client, bucket, key, db_path):
+    """Download the history database from S3, starting empty if it does not exist"""
+    try:
+        s3_client.download_file(bucket, key, db_path)
+        print(f"✓ History store downloaded from s3://{bucket}/{key}")
+    except Exception as e:
+        error_code = getattr(e, 'response', {}).get('Error', {}).get('Code', '')
+        if error_code in ['404', 'NoSuchKey', 'NotFound']:
+            print(f"No history store at s3://{bucket}/{key}, creating a new one")
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        else:
+            raise
+
+
+def upload_history(s3_client, bucket, key, db_path):
+    """Upload the history database to S3"""
+    s3_client.upload_file(db_path, bucket, key)
+    print(f"✓ History store uploaded to s3://{bucket}/{key}")
+
+
+def rows_from_result(result):
+    """Extract history rows (dicts) from an execute_query_and_print result"""
+    col_map = {}
+    for idx, col_name in enumerate(result['header']):
+        col_map[col_name.lower()] = idx
+
+    def value(row, *names):
+        for name in names:
+            if name in col_map and col_map[name] < len(row) and row[col_map[name]]:
+                return row[col_map[name]]
+        return ''
+
+    def number(row, name):
+        try:
+            return float(value(row, name) or 0.0)
+        except (ValueError, TypeError):
+            return 0.0
+
+    rows = []
+    for row in result['data']:
+        rows.append({
+            'account_id': value(row, 'account_id'),
+            'nat_gateway_id': value(row, 'nat_gateway_id'),
+            'availability_zone': value(row, 'availability_zone'),
+            'flow_direction': value(row, 'flow_direction'),
+            'source_ip': value(row, 'srcaddr', 'nat_private_ip'),
+            'destination_ip': value(row, 'dstaddr'),
+            'usage_gb': number(row, 'usage_gb'),
+            'cost_usd': number(row, 'cost_usd')
+        })
+    return rows
+
+
+def record_query_results(conn, day, results):
+    """
+    Store the results of one day's queries.
+
+    Rows previously stored for the same day and query type are replaced, so
+    re-running the Lambda for a day does not duplicate its aggregates.
+    Fan-out results (with `targets` and `rowTargets`) only replace the rows
+    of their own targets and of single-account runs, so a target missing
+    from a run keeps its rows.
+    """
+    recorded_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    inserted = 0
+
+    with conn:
+        for result in results:
+            query_type = result['queryType']
+            row_targets = result.get('rowTargets')
+
+            if row_targets is None:
+                conn.execute(
+                    'DELETE FROM daily_aggregates WHERE date = ? AND query_type = ?',
+                    (day, query_type)
+                )
+                row_targets = [''] * len(result['data'])
+            else:
+                # Rows of an earlier single-account run (target '') would
+                # otherwise be counted again next to the fan-out rows
+                for target in [''] + result['targets']:
+                    conn.execute(
+                        'DELETE FROM daily_aggregates WHERE date = ? AND query_type = ? AND target = ?',
+                        (day, query_type, target)
+                    )
+
+            for row, target in zip(rows_from_result(result), row_targets):
+                conn.execute(
+                    'INSERT INTO daily_aggregates (date, query_type, account_id, nat_gateway_id, '
+                    'availability_zone, flow_direction, source_ip, destination_ip, usage_gb, '
+                    'cost_usd, recorded_at, target) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (day, query_type, row['account_id'], row['nat_gateway_id'],
+                     row['availability_zone'], row['flow_direction'], row['source_ip'],
+                     row['destination_ip'], row['usage_gb'], row['cost_usd'], recorded_at, target)
+                )
+                inserted += 1
+
+    return inserted
+
+
+def query_range(conn, start, end, nat_gateway_id=None, source_ip=None,
+                destination_ip=None, query_types=None):
+    """Return stored rows between start and end (inclusive ISO dates)"""
+    sql = 'SELECT * FROM daily_aggregates WHERE date BETWEEN ? AND ?'
+    params = [start, end]
+
+    if nat_gateway_id:
+        sql += ' AND nat_gateway_id = ?'
+        params.append(nat_gateway_id)
+    if source_ip:
+        sql += ' AND source_ip = ?'
+        params.append(source_ip)
+    if destination_ip:
+        sql += ' AND destination_ip = ?'
+        params.append(destination_ip)
+    if query_types:
+        sql += f" AND query_type IN ({', '.join('?' for _ in query_types)})"
+        params.extend(query_types)
+
+    sql += ' ORDER BY date, query_type, usage_gb DESC'
+    return [dict(row) for row in conn.execute(sql, params)]
+
+
+def gateway_trend(conn, start, end, nat_gateway_id=None):
+    """Return daily usage and cost per NAT gateway between start and end"""
+    sql = (
+        'SELECT date, nat_gateway_id, ROUND(SUM(usage_gb), 4) AS usage_gb, '
+        'ROUND(SUM(cost_usd), 4) AS cost_usd FROM daily_aggregates '
+        'WHERE date BETWEEN ? AND ? AND query_type = ?'
+    )
+    params = [start, end, TOTALS_QUERY_TYPE]
+
+    if nat_gateway_id:
+        sql += ' AND nat_gateway_id = ?'
+        params.append(nat_gateway_id)
+
+    sql += ' GROUP BY date, nat_gateway_id ORDER BY nat_gateway_id, date'
+    return [dict(row) for row in conn.execute(sql, params)]
+
+
+def month_to_date(conn, as_of=None):
+    """Return month-to-date usage and cost per NAT gateway up to as_of (ISO date)"""
+    as_of = as_of or date_cls.today().isoformat()
+    start = as_of[:8] + '01'
+
+    sql = (
+        'SELECT nat_gateway_id, COUNT(DISTINCT date) AS days, '
+        'ROUND(SUM(usage_gb), 4) AS usage_gb, ROUND(SUM(cost_usd), 4) AS cost_usd '
+        'FROM daily_aggregates '
+        'WHERE date BETWEEN ? AND ? AND query_type = ? '
+        'GROUP BY nat_gateway_id ORDER BY cost_usd DESC'
+    )
+    return [dict(row) for row in conn.execute(sql, [start, as_of, TOTALS_QUERY_TYPE])]
+
+
+def print_rows(rows):
+    """Print history rows as a table using the Lambda's table formatter layout"""
+    if not rows:
+        print("No results returned")
+        return
+
+    header = list(rows[0].keys())
+    col_widths = [
+        max(len(h), *(len(str(row[h])) for row in rows)) for h in header
+    ]
+    numeric = ['usage_gb', 'cost_usd', 'days']
+
+    def fmt(values):
+        parts = []
+        for i, h in enumerate(header):
+            if h in numeric:
+                parts.append(str(values[i]).rjust(col_widths[i]))
+            else:
+                parts.append(str(values[i]).ljust(col_widths[i]))
+        return " | ".join(parts)
+
+    header_line = fmt(header)
+    print(header_line)
+    print("-" * len(header_line))
+    for row in rows:
+        print(fmt([row[h] for h in header]))
+    print("-" * len(header_line))
+    print(f"Total rows: {len(rows)}\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Query the NAT Gateway cost history store')
+    parser.add_argument('--db', help='Local SQLite history file')
+    parser.add_argument('--s3-bucket', help='S3 bucket holding the history store (downloaded before querying)')
+    parser.add_argument('--s3-key', default=DEFAULT_HISTORY_KEY, help=f'S3 object key (default: {DEFAULT_HISTORY_KEY})')
+    parser.add_argument('--region', default='us-east-1', help='AWS region (default: us-east-1)')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    range_parser = subparsers.add_parser('range', help='Stored rows for a date range')
+    range_parser.add_argument('start', help='Start date (YYYY-MM-DD)')
+    range_parser.add_argument('end', help='End date (YYYY-MM-DD)')
+    range_parser.add_argument('--nat-gateway-id', help='Filter by NAT gateway')
+    range_parser.add_argument('--source-ip', help='Filter by source IP')
+    range_parser.add_argument('--destination-ip', help='Filter by destination IP')
+    range_parser.add_argument('--query-type', action='append', help='Filter by query type (repeatable)')
+
+    trend_parser = subparsers.add_parser('trend', help='Daily usage and cost per NAT gateway')
+    trend_parser.add_argument('nat_gateway_id', nargs='?', help='NAT gateway (default: all)')
+    trend_parser.add_argument('--start', default='0000-01-01', help='Start date (YYYY-MM-DD)')
+    trend_parser.add_argument('--end', default='9999-12-31', help='End date (YYYY-MM-DD)')
+
+    mtd_parser = subparsers.add_parser('mtd', help='Month-to-date totals per NAT gateway')
+    mtd_parser.add_argument('--as-of', help='Last day to include (default: today)')
+
+    args = parser.parse_args()
+
+    if not args.db and not args.s3_bucket:
+        parser.error('one of --db or --s3-bucket is required')
+
+    try:
+        db_path = args.db
+        if args.s3_bucket:
+            import boto3
+
+            db_path = db_path or os.path.join(tempfile.mkdtemp(), 'nat_cost_history.sqlite')
+            download_history(boto3.client('s3', region_name=args.region), args.s3_bucket, args.s3_key, db_path)
+
+        conn = connect(db_path)
+
+        if args.command == 'range':
+            rows = query_range(conn, args.start, args.end,
+                               nat_gateway_id=args.nat_gateway_id,
+                               source_ip=args.source_ip,
+                               destination_ip=args.destination_ip,
+                               query_types=args.query_type)
+        elif args.command == 'trend':
+            rows = gateway_trend(conn, args.start, args.end, nat_gateway_id=args.nat_gateway_id)
+        else:
+            rows = month_to_date(conn, as_of=args.as_of)
+
+        print_rows(rows)
+
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -1,14 +1,74 @@
 import boto3
 import json
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 import requests
 import uuid
 
+import approximate
+import history_store
+
 athena_client = boto3.client('athena')
 s3_client = boto3.client('s3')
 secrets_client = boto3.client('secretsmanager')
+lambda_client = boto3.client('lambda')
+sts_client = boto3.client('sts')
+
+# Query types in execution order: (SQL file, title)
+QUERY_TYPES = {
+    'public': ('public_ip_traffic.sql', "PUBLIC IP TRAFFIC ANALYSIS (EGRESS)"),
+    'private': ('private_ip_traffic.sql', "PRIVATE IP TRAFFIC ANALYSIS (INGRESS)"),
+    'ingress_private': ('ingress_private_ip_traffic.sql', "INGRESS PRIVATE IP TRAFFIC ANALYSIS"),
+    'egress_public': ('egress_public_ip_traffic.sql', "EGRESS PUBLIC IP TRAFFIC ANALYSIS"),
+    'gateway_totals': ('gateway_daily_totals.sql', "NAT GATEWAY DAILY TOTALS")
+}
+
+# The SQL files are packaged with the function (see build_lambda.sh) rather
+# than passed as environment variables, which are limited to 4 KB in total
+QUERIES_DIR = os.environ.get(
+    'QUERIES_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries')
+)
+
+# Query types that only feed the history store (not sent to DoitHub). The
+# other queries keep only their top 30 rows, so daily totals come from here.
+HISTORY_QUERY_TYPES = ['gateway_totals']
+
+# Seconds kept free at the end of the invocation for the history store and
+# DoitHub phases. Queries still running past this point are stopped.
+POST_QUERY_RESERVE_SECONDS = int(os.environ.get('POST_QUERY_RESERVE_SECONDS', '60'))
+
+# Seconds needed to send one DoitHub batch (matches the request timeout)
+DOITHUB_SEND_SECONDS = 30
+
+# Queries still running at the deadline are left running for the next
+# invocation, unless they have already run longer than this, in which case
+# they are stopped. The default is Athena's 30 minute DML timeout minus the
+# default 300s Lambda timeout: an older query would time out before the
+# next invocation could collect it.
+MAX_QUERY_RUNTIME_SECONDS = int(os.environ.get('MAX_QUERY_RUNTIME_SECONDS', '1500'))
+
+# Restarts of a failed or cancelled query before giving up on the date
+MAX_QUERY_RESTARTS = int(os.environ.get('MAX_QUERY_RESTARTS', '2'))
+
+# Asynchronous self-invocations allowed to resume one checkpoint
+MAX_RESUME_INVOCATIONS = int(os.environ.get('MAX_RESUME_INVOCATIONS', '5'))
+
+# Time budget used when no Lambda context is available (e.g. local runs)
+DEFAULT_TIME_BUDGET_SECONDS = 300
+
+POLL_INTERVAL_SECONDS = 2
+
+CHECKPOINT_PREFIX = 'checkpoints/'
+
+# Appended to the DoitHub provider names of approximate runs
+APPROXIMATE_PROVIDER_SUFFIX = ' (approximate)'
+
+# Maximum number of fan-out targets queried at the same time
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', '8'))
 
 def lambda_handler(event, context):
     """
@@ -18,8 +78,32 @@ def lambda_handler(event, context):
     Always executes both public and private IP queries.
     Sends results to DoitHub API in the required format.
     
-    Event format (optional - ignored):
-    {}
+    The remaining invocation time is budgeted across the query, history and
+    DoitHub phases. Queries still running at the deadline are left running
+    and the progress is checkpointed to S3; the function then invokes itself
+    asynchronously so the next invocation picks up the running queries
+    instead of starting from scratch.
+    
+    In fan-out mode (targets in the event or the S3 target list) the queries run
+    in every target account/region in parallel, assuming each target's role,
+    and the results are merged into one deduplicated set of DoitHub events.
+    Finished targets are delivered even if others failed or ran out of
+    time; those are reported and the next invocation delivers only them.
+    
+    In approximate mode the queries only scan a random subset of the day's
+    hour partitions. usage_gb and cost_usd are scaled up to full-day
+    estimates and reported with 95% confidence intervals. Approximate runs
+    are sent to separate "(approximate)" DoitHub providers and are not
+    recorded in the history store.
+    
+    Event format (optional, defaults from APPROXIMATE_MODE and
+    APPROXIMATE_SAMPLE_HOURS; "date" is set by resumed invocations):
+    {
+        "date": "2026-02-02",
+        "approximate": true,
+        "sampleHours": 6,
+        "targets": [{"roleArn": "...", "region": "...", "workgroup": "...", "resultsBucket": "..."}]
+    }
     """
     
     try:
@@ -28,42 +112,100 @@ def lambda_handler(event, context):
         year = "2026"#today.strftime('%Y')
         month = "2"#today.strftime('%m')
         day = "2"#today.strftime('%d')
+        date = f'{year}-{month}-{day}'
+        
+        # A resumed invocation keeps the date of the checkpoint it resumes,
+        # even when the resume chain crosses midnight
+        if isinstance(event, dict) and event.get('date'):
+            date = event['date']
+            year, month, day = date.split('-')
+        
+        deadline = get_deadline(context)
+        options = get_run_options(event)
+        targets = get_fanout_targets(event)
         
         print(f"\n{'='*80}")
-        print(f"Executing Athena Queries for {year}-{month}-{day}")
+        print(f"Executing Athena Queries for {date}")
+        print(f"Time budget: {deadline - time.time():.0f}s")
         print(f"{'='*80}\n")
         
+        checkpoint = load_checkpoint(date, approximate=options['approximate'], fanout=bool(targets))
+        
+        sample_hours = None
+        query_types = list(QUERY_TYPES)
+        if options['approximate']:
+            if not checkpoint.get('sampleHours'):
+                checkpoint['sampleHours'] = approximate.choose_sample_hours(options['sampleHours'])
+            sample_hours = checkpoint['sampleHours']
+            print(f"Approximate mode: sampling hours {sample_hours} "
+                  f"({len(sample_hours)}/{approximate.HOURS_PER_DAY} of the day)")
+            
+            # Approximate runs are not recorded in the history store
+            query_types = [qt for qt in query_types if qt not in HISTORY_QUERY_TYPES]
+        
         # Get DoitHub API credentials
         doithub_config = get_doithub_credentials()
         
-        # Execute all four queries
-        results_public = execute_query_and_print(
-            query_type='public',
-            year=year,
-            month=month,
-            day=day
-        )
+        target_reports = None
         
-        results_private = execute_query_and_print(
-            query_type='private',
-            year=year,
-            month=month,
-            day=day
-        )
+        if targets:
+            # Execute all queries in every target, then merge the finished
+            # targets that have not been delivered yet
+            save_checkpoint(checkpoint)
+            target_results, target_reports = run_fanout(
+                targets=targets,
+                query_types=query_types,
+                year=year,
+                month=month,
+                day=day,
+                deadline=deadline - POST_QUERY_RESERVE_SECONDS,
+                approximate_mode=options['approximate'],
+                sample_hours=sample_hours
+            )
+            results = plan_fanout_delivery(checkpoint, target_results, query_types)
+        else:
+            # Execute all four queries concurrently within the time budget
+            results = run_queries(
+                query_types=query_types,
+                year=year,
+                month=month,
+                day=day,
+                checkpoint=checkpoint,
+                deadline=deadline - POST_QUERY_RESERVE_SECONDS,
+                sample_hours=sample_hours
+            )
         
-        results_ingress_private = execute_query_and_print(
-            query_type='ingress_private',
-            year=year,
-            month=month,
-            day=day
-        )
+        if results is None:
+            return checkpoint_response(checkpoint, 'Query phase did not finish within the time budget', target_reports, event, context, targets)
         
-        results_egress_public = execute_query_and_print(
-            query_type='egress_public',
-            year=year,
-            month=month,
-            day=day
-        )
+        if targets:
+            print(f"Delivering fan-out targets: {', '.join(checkpoint['deliveringTargets'])}")
+        
+        results_public = results['public']
+        results_private = results['private']
+        results_ingress_private = results['ingress_private']
+        results_egress_public = results['egress_public']
+        
+        # Approximate events go to their own providers so dashboards summing the
+        # exact providers never count a day twice
+        summary_provider = 'NAT Gateway usage summary'
+        top_provider = 'Nat Gateway usage top'
+        if sample_hours:
+            summary_provider += APPROXIMATE_PROVIDER_SUFFIX
+            top_provider += APPROXIMATE_PROVIDER_SUFFIX
+        
+        # Append the day's aggregates to the history store (exact runs only)
+        if sample_hours:
+            print("Approximate mode: skipping history store")
+        elif not checkpoint['historyRecorded']:
+            if record_history(
+                results=[results[query_type] for query_type in query_types],
+                year=year,
+                month=month,
+                day=day
+            ):
+                checkpoint['historyRecorded'] = True
+                save_checkpoint(checkpoint)
         
         # Send results to DoitHub
         print(f"\n{'-'*80}")
@@ -71,37 +213,85 @@ def lambda_handler(event, context):
         print(f"{'-'*80}\n")
         
         # Send first batch (queries 1 & 2) - Summary
-        print("Batch 1: NAT Gateway usage summary (queries 1 & 2)")
-        send_to_doithub(
-            doithub_config=doithub_config,
-            results=[results_public, results_private],
-            date=f'{year}-{month}-{day}',
-            provider='NAT Gateway usage summary'
-        )
+        if 'summary' in checkpoint['batchesSent']:
+            print("Batch 1: already sent (resumed from checkpoint)")
+        elif not has_time_left(deadline, DOITHUB_SEND_SECONDS):
+            return checkpoint_response(checkpoint, 'Not enough time left to send batch 1 to DoitHub', target_reports, event, context, targets)
+        else:
+            print(f"Batch 1: {summary_provider} (queries 1 & 2)")
+            send_to_doithub(
+                doithub_config=doithub_config,
+                results=[results_public, results_private],
+                date=date,
+                provider=summary_provider
+            )
+            checkpoint['batchesSent'].append('summary')
+            save_checkpoint(checkpoint)
         
         # Send second batch (queries 3 & 4) - Top
-        print("\nBatch 2: NAT Gateway usage top (queries 3 & 4)")
-        send_to_doithub(
-            doithub_config=doithub_config,
-            results=[results_ingress_private, results_egress_public],
-            date=f'{year}-{month}-{day}',
-            provider='Nat Gateway usage top'
-        )
+        if 'top' in checkpoint['batchesSent']:
+            print("\nBatch 2: already sent (resumed from checkpoint)")
+        elif not has_time_left(deadline, DOITHUB_SEND_SECONDS):
+            return checkpoint_response(checkpoint, 'Not enough time left to send batch 2 to DoitHub', target_reports, event, context, targets)
+        else:
+            print(f"\nBatch 2: {top_provider} (queries 3 & 4)")
+            send_to_doithub(
+                doithub_config=doithub_config,
+                results=[results_ingress_private, results_egress_public],
+                date=date,
+                provider=top_provider
+            )
+            checkpoint['batchesSent'].append('top')
+            save_checkpoint(checkpoint)
+        
+        # Keep the checkpoint so a resumed invocation retries only the history step
+        if not sample_hours and not checkpoint['historyRecorded']:
+            return checkpoint_response(checkpoint, 'History store update failed, will be retried', target_reports, event, context, targets)
+        
+        if targets:
+            # Failed and incomplete targets keep the date open; the next
+            # invocation delivers only them
+            checkpoint['deliveredTargets'] += checkpoint['deliveringTargets']
+            checkpoint['deliveringTargets'] = []
+            checkpoint['historyRecorded'] = False
+            checkpoint['batchesSent'] = []
+            save_checkpoint(checkpoint)
+            
+            for report in target_reports:
+                report['delivered'] = report['name'] in checkpoint['deliveredTargets']
+            
+            undelivered = [report['name'] for report in target_reports if not report['delivered']]
+            if undelivered:
+                return checkpoint_response(
+                    checkpoint,
+                    f"Fan-out targets not delivered yet, will be retried: {', '.join(undelivered)}",
+                    target_reports,
+                    event,
+                    context,
+                    targets
+                )
+        
+        clear_checkpoint(checkpoint)
+        for report in target_reports or []:
+            clear_checkpoint(dict(checkpoint, target=report['name']))
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'All queries executed and results sent to DoitHub in 2 batches',
-                'date': f'{year}-{month}-{day}',
+                'date': date,
+                'approximate': bool(sample_hours),
+                'sampleHours': sample_hours,
+                'targets': target_reports,
                 'batch1': {
-                    'provider': 'NAT Gateway usage summary',
+                    'provider': summary_provider,
                     'publicIPRowCount': results_public['rowCount'],
                     'privateIPRowCount': results_private['rowCount'],
                     'publicIPQueryId': results_public['queryExecutionId'],
                     'privateIPQueryId': results_private['queryExecutionId']
                 },
                 'batch2': {
-                    'provider': 'Nat Gateway usage top',
+                    'provider': top_provider,
                     'ingressPrivateIPRowCount': results_ingress_private['rowCount'],
                     'egressPublicIPRowCount': results_egress_public['rowCount'],
                     'ingressPrivateIPQueryId': results_ingress_private['queryExecutionId'],
@@ -118,6 +308,274 @@ def lambda_handler(event, context):
         }
 
 
+def get_deadline(context):
+    """Return the time (epoch seconds) at which the invocation will be stopped"""
+    
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return time.time() + context.get_remaining_time_in_millis() / 1000.0
+    
+    return time.time() + DEFAULT_TIME_BUDGET_SECONDS
+
+
+def get_run_options(event):
+    """Read the run mode from the event, falling back to environment defaults"""
+    
+    event = event if isinstance(event, dict) else {}
+    
+    approximate_mode = event.get('approximate', os.environ.get('APPROXIMATE_MODE', 'false'))
+    if isinstance(approximate_mode, str):
+        approximate_mode = approximate_mode.lower() == 'true'
+    sample_hours = int(event.get(
+        'sampleHours',
+        os.environ.get('APPROXIMATE_SAMPLE_HOURS', '6')
+    ))
+    
+    return {
+        'approximate': bool(approximate_mode),
+        'sampleHours': sample_hours
+    }
+
+
+def has_time_left(deadline, seconds):
+    """Check whether at least `seconds` remain before the deadline"""
+    
+    remaining = deadline - time.time()
+    
+    if remaining < seconds:
+        print(f"⚠ Only {remaining:.0f}s left, {seconds}s needed")
+        return False
+    
+    return True
+
+
+def checkpoint_response(checkpoint, message, target_reports=None, event=None, context=None, targets=None):
+    """
+    Build the response for an invocation that stopped early, scheduling its
+    resumption. If no resume could be scheduled, the queries still running
+    (in `targets` for a fan-out run) are stopped rather than left scanning
+    with no invocation to collect them.
+    """
+    
+    print(f"\n⚠ {message}")
+    print("Progress checkpointed, the next invocation will resume from it")
+    
+    resume_scheduled = schedule_resume(checkpoint, event, context)
+    if not resume_scheduled:
+        stop_checkpoint_queries(checkpoint, targets=targets)
+    queries = checkpoint['queries']
+    
+    body = {
+        'message': message,
+        'date': checkpoint['date'],
+        'approximate': checkpoint['approximate'],
+        'resumable': True,
+        'resumeScheduled': resume_scheduled,
+        'historyRecorded': checkpoint['historyRecorded'],
+        'batchesSent': checkpoint['batchesSent']
+    }
+    
+    if target_reports is not None:
+        body['targets'] = target_reports
+    else:
+        body['completedQueries'] = [qt for qt in QUERY_TYPES if queries.get(qt, {}).get('result')]
+        body['pendingQueries'] = [qt for qt in QUERY_TYPES if not queries.get(qt, {}).get('result')]
+    
+    return {
+        'statusCode': 202,
+        'body': json.dumps(body)
+    }
+
+
+def stop_checkpoint_queries(checkpoint, targets=None):
+    """
+    Stop the queries a checkpoint (or each fan-out target's checkpoint)
+    still has running. Their IDs are cleared, so the next invocation for the
+    date starts them again without counting a restart.
+    """
+    
+    if targets:
+        checkpoints = [
+            (load_checkpoint(checkpoint['date'], approximate=checkpoint['approximate'], fanout=True, target=target['name']), target)
+            for target in targets
+        ]
+    else:
+        checkpoints = [(checkpoint, None)]
+    
+    for target_checkpoint, target in checkpoints:
+        queries = target_checkpoint['queries']
+        running = {
+            query_type: entry['queryExecutionId']
+            for query_type, entry in queries.items()
+            if entry.get('queryExecutionId') and not entry.get('result')
+        }
+        
+        if not running:
+            continue
+        
+        print(f"No resume scheduled, stopping {len(running)} running queries")
+        
+        try:
+            stop_queries(running, target=connect_target(target) if target else None)
+        except Exception as e:
+            print(f"Warning: Failed to stop queries of {target['name'] if target else 'local'}: {str(e)}")
+            continue
+        
+        for query_type in running:
+            queries[query_type]['queryExecutionId'] = None
+        save_checkpoint(target_checkpoint)
+
+
+def schedule_resume(checkpoint, event, context):
+    """
+    Invoke this function again asynchronously with the same event, plus the
+    checkpoint's date, so that it resumes from the checkpoint. Bounded by MAX_RESUME_INVOCATIONS per
+    checkpoint; disabled with RESUME_SELF_INVOKE=false.
+    """
+    
+    if os.environ.get('RESUME_SELF_INVOKE', 'true').lower() != 'true':
+        print("RESUME_SELF_INVOKE disabled, waiting for the next scheduled invocation")
+        return False
+    
+    if context is None or not hasattr(context, 'invoked_function_arn'):
+        print("No Lambda context, not scheduling a resume")
+        return False
+    
+    if checkpoint['resumeInvocations'] >= MAX_RESUME_INVOCATIONS:
+        print(f"⚠ Resumed {checkpoint['resumeInvocations']} times already, not invoking again")
+        return False
+    
+    try:
+        checkpoint['resumeInvocations'] += 1
+        save_checkpoint(checkpoint)
+        
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(dict(event if isinstance(event, dict) else {}, date=checkpoint['date'])).encode('utf-8')
+        )
+        print(f"✓ Resume scheduled ({checkpoint['resumeInvocations']}/{MAX_RESUME_INVOCATIONS})")
+        return True
+    except Exception as e:
+        print(f"Warning: Failed to schedule resume: {str(e)}")
+        return False
+
+
+def checkpoint_key(checkpoint):
+    """
+    S3 key of a checkpoint. Exact, approximate and fan-out runs are kept
+    apart, and every fan-out target has its own checkpoint.
+    """
+    suffix = '-approximate' if checkpoint['approximate'] else ''
+    suffix += '-fanout' if checkpoint.get('fanout') else ''
+    target = f"/{checkpoint['target']}" if checkpoint.get('target') else ''
+    return f"{CHECKPOINT_PREFIX}{checkpoint['date']}{suffix}{target}.json"
+
+
+def load_checkpoint(date, approximate=False, fanout=False, target=None):
+    """Load the checkpoint for a date (and fan-out target) from S3, or start a new one"""
+    
+    checkpoint = {
+        'date': date,
+        'approximate': approximate,
+        'fanout': fanout,
+        'target': target,
+        'queries': {},
+        'historyRecorded': False,
+        'batchesSent': [],
+        'resumeInvocations': 0
+    }
+    
+    if fanout and not target:
+        # Targets already sent to DoitHub, and the ones being sent now
+        checkpoint['deliveredTargets'] = []
+        checkpoint['deliveringTargets'] = []
+    
+    bucket = os.environ.get('ATHENA_RESULTS_BUCKET')
+    
+    try:
+        key = checkpoint_key(checkpoint)
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        checkpoint.update(json.loads(response['Body'].read()))
+        print(f"✓ Resuming from checkpoint s3://{bucket}/{key}")
+    except s3_client.exceptions.NoSuchKey:
+        print("No checkpoint found, starting from scratch")
+    except Exception as e:
+        print(f"Warning: Failed to load checkpoint, starting from scratch: {str(e)}")
+    
+    return checkpoint
+
+
+def save_checkpoint(checkpoint):
+    """Save the checkpoint to S3 (best effort)"""
+    
+    bucket = os.environ.get('ATHENA_RESULTS_BUCKET')
+    
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=checkpoint_key(checkpoint),
+            Body=json.dumps(checkpoint).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Warning: Failed to save checkpoint: {str(e)}")
+
+
+def clear_checkpoint(checkpoint):
+    """Delete the checkpoint once the date has been fully processed"""
+    
+    bucket = os.environ.get('ATHENA_RESULTS_BUCKET')
+    
+    try:
+        s3_client.delete_object(Bucket=bucket, Key=checkpoint_key(checkpoint))
+    except Exception as e:
+        print(f"Warning: Failed to delete checkpoint: {str(e)}")
+
+
+def record_history(results, year, month, day):
+    """
+    Append query results to the S3-backed history store (best effort).
+    
+    Returns True if the store was updated (or is not configured), False if
+    the update failed and should be retried.
+    """
+    
+    bucket = os.environ.get('HISTORY_BUCKET')
+    
+    if not bucket:
+        print("HISTORY_BUCKET not set, skipping history store")
+        return True
+    
+    key = os.environ.get('HISTORY_KEY', history_store.DEFAULT_HISTORY_KEY)
+    db_path = '/tmp/nat_cost_history.sqlite'
+    
+    try:
+        print(f"\n{'-'*80}")
+        print("Appending results to history store")
+        print(f"{'-'*80}\n")
+        
+        history_store.download_history(s3_client, bucket, key, db_path)
+        
+        conn = history_store.connect(db_path)
+        try:
+            inserted = history_store.record_query_results(
+                conn,
+                history_store.normalize_date(year, month, day),
+                results
+            )
+        finally:
+            conn.close()
+        
+        history_store.upload_history(s3_client, bucket, key, db_path)
+        print(f"Rows recorded: {inserted}")
+        return True
+    
+    except Exception as e:
+        # The history store must never block delivery to DoitHub
+        print(f"Warning: Failed to update history store: {str(e)}")
+        return False
+
+
 def get_doithub_credentials():
     """Retrieve DoitHub API credentials from AWS Secrets Manager"""
     
@@ -250,6 +708,9 @@ def convert_to_doithub_events(results, header, date, provider):
             except (ValueError, TypeError):
                 cost_usd = 0.0
             
+            # Confidence intervals are only present in approximate mode
+            is_approximate = 'usage_gb_ci95' in col_map
+            
             # Generate UUID for event ID
             event_id = str(uuid.uuid4())
             
@@ -290,22 +751,41 @@ def convert_to_doithub_events(results, header, date, provider):
                     'value': dstaddr
                 })
             
+            metrics = [
+                {
+                    'value': usage_gb,
+                    'type': 'usage_gb'
+                },
+                {
+                    'value': cost_usd,
+                    'type': 'cost_usd'
+                }
+            ]
+            
+            # Add estimate marker and confidence intervals in approximate mode
+            if is_approximate:
+                dimensions.append({
+                    'key': 'estimate',
+                    'type': 'label',
+                    'value': 'approximate'
+                })
+                for metric in ['usage_gb', 'cost_usd']:
+                    try:
+                        ci95 = float(row[col_map.get(f'{metric}_ci95')])
+                    except (ValueError, TypeError):
+                        ci95 = 0.0
+                    metrics.append({
+                        'value': ci95,
+                        'type': f'{metric}_ci95'
+                    })
+            
             # Create event in DoitHub format
             event = {
                 'provider': provider,
                 'id': event_id,
                 'dimensions': dimensions,
                 'time': current_timestamp,
-                'metrics': [
-                    {
-                        'value': usage_gb,
-                        'type': 'usage_gb'
-                    },
-                    {
-                        'value': cost_usd,
-                        'type': 'cost_usd'
-                    }
-                ]
+                'metrics': metrics
             }
             
             events.append(event)
@@ -320,77 +800,523 @@ def convert_to_doithub_events(results, header, date, provider):
     return events
 
 
-def execute_query_and_print(query_type, year, month, day):
-    """Execute a single query and print results"""
+def get_local_target():
+    """The Lambda's own account, region, workgroup and database"""
+    
+    return {
+        'name': 'local',
+        'athena': athena_client,
+        'region': os.environ.get('AWS_REGION'),
+        'workgroup': os.environ.get('ATHENA_WORKGROUP'),
+        'database': os.environ.get('ATHENA_DATABASE'),
+        'resultsBucket': os.environ.get('ATHENA_RESULTS_BUCKET')
+    }
+
+
+def get_fanout_targets(event):
+    """
+    Read the fan-out targets from the event or the JSON list at
+    s3://FANOUT_TARGETS_BUCKET/FANOUT_TARGETS_KEY. Returns an empty list
+    when fan-out is not used.
+    
+    Target format (region is required, and so are workgroup and resultsBucket
+    when roleArn is set or the region is not the Lambda's, since the
+    Lambda's own workgroup and bucket do not exist in another account or
+    region; the rest default to the Lambda's own role and Athena settings):
+    {
+        "name": "prod-eu-west-1",
+        "roleArn": "arn:aws:iam::111111111111:role/nat-cost-athena-query",
+        "externalId": "...",
+        "region": "eu-west-1",
+        "workgroup": "...",
+        "database": "...",
+        "resultsBucket": "..."
+    }
+    """
+    
+    targets = event.get('targets') if isinstance(event, dict) else None
+    
+    if targets is None:
+        targets = load_fanout_targets()
+    
+    local = get_local_target()
+    normalized = []
+    names = set()
+    
+    for target in targets:
+        if not target.get('region'):
+            raise Exception(f'Fan-out target is missing a region: {target}')
+        
+        role_arn = target.get('roleArn')
+        account = role_arn.split(':')[4] if role_arn else 'local'
+        
+        if (role_arn or target['region'] != local['region']) and not (target.get('workgroup') and target.get('resultsBucket')):
+            raise Exception(
+                f'Fan-out target with a roleArn or in another region must set workgroup and resultsBucket: {target}'
+            )
+        
+        entry = {
+            'name': target.get('name') or f"{account}-{target['region']}",
+            'roleArn': role_arn,
+            'externalId': target.get('externalId'),
+            'region': target['region'],
+            'workgroup': target.get('workgroup') or local['workgroup'],
+            'database': target.get('database') or local['database'],
+            'resultsBucket': target.get('resultsBucket') or local['resultsBucket']
+        }
+        
+        if entry['name'] in names:
+            raise Exception(f"Duplicate fan-out target name: {entry['name']}")
+        
+        names.add(entry['name'])
+        normalized.append(entry)
+    
+    return normalized
+
+
+def load_fanout_targets():
+    """
+    Load the configured fan-out target list from S3. The list is not kept in
+    the environment, which Lambda limits to 4 KB for all variables.
+    """
+    
+    bucket = os.environ.get('FANOUT_TARGETS_BUCKET')
+    key = os.environ.get('FANOUT_TARGETS_KEY')
+    
+    if not bucket or not key:
+        return []
     
     try:
-        # Get query from environment variables
-        if query_type == 'public':
-            query = os.environ.get('PUBLIC_IP_QUERY')
-            title = "PUBLIC IP TRAFFIC ANALYSIS (EGRESS)"
-        elif query_type == 'private':
-            query = os.environ.get('PRIVATE_IP_QUERY')
-            title = "PRIVATE IP TRAFFIC ANALYSIS (INGRESS)"
-        elif query_type == 'ingress_private':
-            query = os.environ.get('INGRESS_PRIVATE_IP_QUERY')
-            title = "INGRESS PRIVATE IP TRAFFIC ANALYSIS"
-        elif query_type == 'egress_public':
-            query = os.environ.get('EGRESS_PUBLIC_IP_QUERY')
-            title = "EGRESS PUBLIC IP TRAFFIC ANALYSIS"
-        else:
-            raise Exception(f'Unknown query type: {query_type}')
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return []
+    
+    return json.loads(response['Body'].read())
+
+
+def connect_target(target):
+    """Create an Athena client for a fan-out target, assuming its role if set"""
+    
+    credentials = {}
+    
+    if target['roleArn']:
+        assume_role_args = {
+            'RoleArn': target['roleArn'],
+            'RoleSessionName': re.sub(r'[^\w+=,.@-]', '-', f"nat-cost-{target['name']}")[:64]
+        }
+        if target['externalId']:
+            assume_role_args['ExternalId'] = target['externalId']
         
-        if not query:
-            raise Exception(f'{query_type} query not found in environment')
+        response = sts_client.assume_role(**assume_role_args)
         
-        print(f"\n{'-'*80}")
-        print(f"{title}")
-        print(f"Date: {year}-{month}-{day}")
-        print(f"{'-'*80}\n")
+        credentials = {
+            'aws_access_key_id': response['Credentials']['AccessKeyId'],
+            'aws_secret_access_key': response['Credentials']['SecretAccessKey'],
+            'aws_session_token': response['Credentials']['SessionToken']
+        }
+    
+    # Sessions are not thread-safe, so every target gets its own
+    session = boto3.session.Session(region_name=target['region'], **credentials)
+    
+    return dict(target, athena=session.client('athena'))
+
+
+def retarget_query(query, database):
+    """Point the fully qualified table names of a query at another database"""
+    
+    local_database = os.environ.get('ATHENA_DATABASE')
+    
+    if not local_database or database == local_database:
+        return query
+    
+    return query.replace(f'"{local_database}".', f'"{database}".')
+
+
+def run_fanout(targets, query_types, year, month, day, deadline, approximate_mode=False, sample_hours=None):
+    """
+    Run the queries in every fan-out target in parallel with a bounded pool.
+    
+    Each target has its own checkpoint and is isolated from the others: a
+    failing or incomplete target is reported and skipped. Targets whose
+    checkpoint already holds every result are not queried again. Returns
+    (name, results) for every finished target and a per-target report.
+    """
+    
+    date = f'{year}-{month}-{day}'
+    
+    def run_target(target):
+        started = time.time()
+        report = {
+            'name': target['name'],
+            'region': target['region'],
+            'roleArn': target['roleArn']
+        }
+        results = None
         
-        # Execute Athena query
+        try:
+            checkpoint = load_checkpoint(date, approximate=approximate_mode, fanout=True, target=target['name'])
+            queries = checkpoint['queries']
+            if all(queries.get(query_type, {}).get('result') for query_type in query_types):
+                results = {query_type: queries[query_type]['result'] for query_type in query_types}
+            else:
+                results = run_queries(
+                    query_types=query_types,
+                    year=year,
+                    month=month,
+                    day=day,
+                    checkpoint=checkpoint,
+                    deadline=deadline,
+                    sample_hours=sample_hours,
+                    target=connect_target(target)
+                )
+            report['status'] = 'succeeded' if results else 'incomplete'
+            if results:
+                report['rowCounts'] = {query_type: results[query_type]['rowCount'] for query_type in results}
+        except Exception as e:
+            print(f"⚠ Target {target['name']} failed: {str(e)}")
+            report['status'] = 'failed'
+            report['error'] = str(e)
+        
+        report['durationSeconds'] = round(time.time() - started, 1)
+        return results, report
+    
+    print(f"Fan-out across {len(targets)} targets (max {FANOUT_MAX_WORKERS} in parallel)")
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(FANOUT_MAX_WORKERS, len(targets)))) as executor:
+        outcomes = list(executor.map(run_target, targets))
+    
+    reports = [report for _, report in outcomes]
+    
+    print(f"\n{'-'*80}")
+    print("Fan-out summary")
+    print(f"{'-'*80}\n")
+    print_results_table(
+        [['target', 'region', 'status', 'duration_seconds']] +
+        [[r['name'], r['region'], r['status'], r['durationSeconds']] for r in reports]
+    )
+    
+    succeeded = [(report['name'], results) for results, report in outcomes if results]
+    
+    if all(report['status'] == 'failed' for report in reports):
+        raise Exception('All fan-out targets failed')
+    
+    return succeeded, reports
+
+
+def plan_fanout_delivery(checkpoint, target_results, query_types):
+    """
+    Merge the results of the fan-out targets delivered by this invocation.
+    
+    Finished targets that have not been delivered are recorded in the
+    checkpoint as `deliveringTargets` and sent together, so a resumed
+    invocation retries the same set. Rows of targets delivered earlier are
+    not sent again. Returns None if no target is ready to be delivered.
+    """
+    
+    finished = dict(target_results)
+    
+    if not checkpoint['deliveringTargets']:
+        checkpoint['deliveringTargets'] = [
+            name for name, _ in target_results if name not in checkpoint['deliveredTargets']
+        ]
+        save_checkpoint(checkpoint)
+    
+    if not checkpoint['deliveringTargets']:
+        return None
+    
+    missing = [name for name in checkpoint['deliveringTargets'] if name not in finished]
+    if missing:
+        print(f"⚠ Results of {', '.join(missing)} are not available, retrying the delivery later")
+        return None
+    
+    return merge_results(
+        [(name, finished[name]) for name in checkpoint['deliveringTargets']],
+        query_types,
+        delivered=[(name, finished[name]) for name in checkpoint['deliveredTargets'] if name in finished]
+    )
+
+
+def merge_results(target_results, query_types, delivered=()):
+    """
+    Merge per-target results into one deduplicated result per query type.
+    
+    Rows with the same dimensions (every column except the metrics) are
+    kept once, so targets that overlap (e.g. two regions reading the same
+    organisation flow-log table) do not produce duplicate DoitHub events.
+    Rows of `delivered` targets were sent by an earlier invocation: they
+    are only used to drop duplicates. Each merged result lists its
+    `targets` and the target of every row (`rowTargets`).
+    """
+    
+    merged = {}
+    delivered_names = {name for name, _ in delivered}
+    
+    for query_type in query_types:
+        header = []
+        data = []
+        seen = set()
+        query_execution_ids = {}
+        duplicates = 0
+        
+        for name, results in list(delivered) + list(target_results):
+            result = results[query_type]
+            header = header or result['header']
+            if name not in delivered_names:
+                query_execution_ids[name] = result['queryExecutionId']
+            
+            dimension_idx = [
+                i for i, col_name in enumerate(result['header'])
+                if col_name.lower() not in approximate.METRIC_COLUMNS and not col_name.lower().endswith('_ci95')
+            ]
+            
+            for row in result['data']:
+                key = tuple(row[i] for i in dimension_idx if i < len(row))
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if name not in delivered_names:
+                    data.append((name, row))
+        
+        if duplicates:
+            print(f"Dropped {duplicates} duplicate {query_type} rows across targets")
+        
+        if 'usage_gb' in header:
+            usage_idx = header.index('usage_gb')
+            
+            def usage(item):
+                try:
+                    return float(item[1][usage_idx])
+                except (ValueError, TypeError, IndexError):
+                    return 0.0
+            
+            data.sort(key=usage, reverse=True)
+        
+        merged[query_type] = {
+            'queryExecutionId': query_execution_ids,
+            'queryType': query_type,
+            'rowCount': len(data),
+            'header': header,
+            'data': [row for _, row in data],
+            'targets': [name for name, _ in target_results],
+            'rowTargets': [name for name, _ in data]
+        }
+    
+    return merged
+
+
+def get_query(query_type):
+    """Get the query and its title from the packaged SQL files"""
+    
+    if query_type not in QUERY_TYPES:
+        raise Exception(f'Unknown query type: {query_type}')
+    
+    file_name, title = QUERY_TYPES[query_type]
+    path = os.path.join(QUERIES_DIR, file_name)
+    
+    if not os.path.exists(path):
+        raise Exception(f'{query_type} query not found at {path}')
+    
+    with open(path) as query_file:
+        query = query_file.read()
+    
+    if not query.strip():
+        raise Exception(f'{query_type} query at {path} is empty')
+    
+    return query, title
+
+
+def run_queries(query_types, year, month, day, checkpoint, deadline, sample_hours=None, target=None):
+    """
+    Run queries concurrently until they all finish or the deadline passes.
+    
+    Results already in the checkpoint are reused, queries started by an
+    earlier invocation that are still running are picked up again, and the
+    others are started now. Queries still running at the deadline are left
+    running (their IDs are checkpointed) unless they have exceeded
+    MAX_QUERY_RUNTIME_SECONDS. Failed or cancelled queries are restarted,
+    in this invocation or the next, at most MAX_QUERY_RESTARTS times; when
+    a query gives up, every query still running is stopped.
+    With sample_hours the queries are rewritten for approximate mode. The
+    queries run in `target` (see get_local_target), by default the Lambda's
+    own account.
+    
+    Returns the results keyed by query type, or None if the deadline passed.
+    """
+    
+    target = target or get_local_target()
+    queries = checkpoint['queries']
+    pending = {}
+    
+    def start_query(query_type, restarts):
+        query, title = get_query(query_type)
+        query = retarget_query(query, target['database'])
+        if sample_hours:
+            query = approximate.rewrite_query(query, sample_hours)
         query_execution_id = execute_athena_query(
             query=query,
             year=year,
             month=month,
-            day=day
+            day=day,
+            target=target
         )
+        print(f"Started {title} [{target['name']}]: {query_execution_id}")
         
-        print(f"Query execution ID: {query_execution_id}")
-        
-        # Wait for query to complete
-        query_status = wait_for_query_completion(query_execution_id)
-        
-        if query_status != 'SUCCEEDED':
-            raise Exception(f'Query failed with status: {query_status}')
-        
-        # Get query results
-        results = get_query_results(query_execution_id)
+        queries[query_type] = {'queryExecutionId': query_execution_id, 'result': None, 'restarts': restarts}
+        pending[query_type] = query_execution_id
+    
+    def restart_query(query_type, query_execution_id, status):
+        restarts = queries.get(query_type, {}).get('restarts', 0) + 1
+        if restarts > MAX_QUERY_RESTARTS:
+            # A later invocation for the date starts it with a fresh budget
+            queries[query_type] = {'queryExecutionId': None, 'result': None, 'restarts': 0}
+            raise Exception(
+                f'{query_type} query ended with {status} after {MAX_QUERY_RESTARTS} restarts, giving up'
+            )
+        print(f"{query_type} query {query_execution_id} ended with {status}, "
+              f"restarting ({restarts}/{MAX_QUERY_RESTARTS})")
+        start_query(query_type, restarts)
+    
+    if deadline <= time.time():
+        print("⚠ No time left in the query budget, not starting any query")
+        return None
+    
+    try:
+        for query_type in query_types:
+            entry = queries.get(query_type, {})
+            query_execution_id = entry.get('queryExecutionId')
+            
+            if entry.get('result'):
+                print(f"✓ {query_type} query {query_execution_id} already completed (checkpoint)")
+                continue
+            
+            if not query_execution_id:
+                # New, or stopped by this Lambda when an earlier run gave up
+                start_query(query_type, entry.get('restarts', 0))
+                continue
+            
+            status = get_query_status(query_execution_id, target=target)
+            if status in ['QUEUED', 'RUNNING', 'SUCCEEDED']:
+                print(f"Resuming {query_type} query {query_execution_id} ({status})")
+                pending[query_type] = query_execution_id
+            else:
+                restart_query(query_type, query_execution_id, status)
         
-        # Print results
-        print_results_table(results)
+        save_checkpoint(checkpoint)
         
-        return {
-            'queryExecutionId': query_execution_id,
-            'queryType': query_type,
-            'rowCount': len(results) - 1,  # Exclude header
-            'header': results[0] if results else [],
-            'data': results[1:] if results else []
-        }
+        while pending:
+            for query_type, query_execution_id in list(pending.items()):
+                status = get_query_status(query_execution_id, target=target)
+                
+                if status == 'SUCCEEDED':
+                    queries[query_type]['result'] = collect_query_results(
+                        query_type=query_type,
+                        query_execution_id=query_execution_id,
+                        year=year,
+                        month=month,
+                        day=day,
+                        sample_hours=sample_hours,
+                        target=target
+                    )
+                    del pending[query_type]
+                    save_checkpoint(checkpoint)
+                elif status in ['FAILED', 'CANCELLED']:
+                    del pending[query_type]
+                    restart_query(query_type, query_execution_id, status)
+                    save_checkpoint(checkpoint)
+            
+            if not pending:
+                break
+            
+            remaining = deadline - time.time()
+            
+            if remaining <= 0:
+                print(f"⚠ [{target['name']}] Query budget exhausted with {len(pending)} queries still running")
+                
+                # Only queries that cannot finish are stopped; the others keep
+                # running and are picked up by the next invocation
+                over_limit = {
+                    query_type: query_execution_id
+                    for query_type, query_execution_id in pending.items()
+                    if get_query_runtime(query_execution_id, target=target) >= MAX_QUERY_RUNTIME_SECONDS
+                }
+                stop_queries(over_limit, target=target)
+                
+                for query_type in pending:
+                    if query_type not in over_limit:
+                        print(f"Leaving {query_type} query {pending[query_type]} running for the next invocation")
+                
+                save_checkpoint(checkpoint)
+                return None
+            
+            print(f"[{target['name']}] Waiting for {', '.join(pending)} ({remaining:.0f}s left in query budget)")
+            time.sleep(min(POLL_INTERVAL_SECONDS, remaining))
     
     except Exception as e:
-        print(f"Error executing {query_type} query: {str(e)}")
+        # Nothing resumes a run that raised, so stop the queries still
+        # running instead of leaving them scanning; they are started again
+        # (without counting a restart) if the date is re-run
+        print(f"[{target['name']}] Error executing queries: {str(e)}")
+        stop_queries(pending, target=target)
+        for query_type in pending:
+            queries[query_type]['queryExecutionId'] = None
+        save_checkpoint(checkpoint)
         raise
+    
+    return {query_type: queries[query_type]['result'] for query_type in query_types}
+
+
+def collect_query_results(query_type, query_execution_id, year, month, day, sample_hours=None, target=None):
+    """Fetch and print the results of a completed query"""
+    
+    target = target or get_local_target()
+    _, title = get_query(query_type)
+    
+    print(f"\n{'-'*80}")
+    print(f"{title}")
+    print(f"Target: {target['name']}")
+    print(f"Date: {year}-{month}-{day}")
+    print(f"Query execution ID: {query_execution_id}")
+    if sample_hours:
+        print(f"APPROXIMATE: estimated from hours {sample_hours}, ±95% confidence intervals")
+    print(f"{'-'*80}\n")
+    
+    results = get_query_results(query_execution_id, target=target)
+    
+    print_results_table(results)
+    
+    return {
+        'queryExecutionId': query_execution_id,
+        'queryType': query_type,
+        'rowCount': len(results) - 1,  # Exclude header
+        'header': results[0] if results else [],
+        'data': results[1:] if results else []
+    }
+
+
+def stop_queries(pending, target=None):
+    """Stop running queries so they do not keep scanning (and billing)"""
+    
+    target = target or get_local_target()
+    
+    for query_type, query_execution_id in pending.items():
+        try:
+            target['athena'].stop_query_execution(QueryExecutionId=query_execution_id)
+            print(f"Stopped {query_type} query {query_execution_id}")
+        except Exception as e:
+            print(f"Warning: Failed to stop {query_type} query {query_execution_id}: {str(e)}")
 
 
-def execute_athena_query(query, year, month, day):
+def execute_athena_query(query, year, month, day, target=None):
     """Execute Athena query with parameters"""
     
-    output_location = f's3://{os.environ.get("ATHENA_RESULTS_BUCKET")}/query-results/'
-    workgroup = os.environ.get('ATHENA_WORKGROUP')
-    database = os.environ.get('ATHENA_DATABASE')
+    target = target or get_local_target()
+    
+    output_location = f's3://{target["resultsBucket"]}/query-results/'
+    workgroup = target['workgroup']
+    database = target['database']
     
-    response = athena_client.start_query_execution(
+    response = target['athena'].start_query_execution(
         QueryString=query,
         QueryExecutionContext={
             'Database': database
@@ -405,34 +1331,46 @@ def execute_athena_query(query, year, month, day):
     return response['QueryExecutionId']
 
 
-def wait_for_query_completion(query_execution_id, max_attempts=60):
-    """Wait for Athena query to complete"""
+def get_query_status(query_execution_id, target=None):
+    """Get the current state of an Athena query"""
     
-    attempt = 0
-    while attempt < max_attempts:
-        response = athena_client.get_query_execution(
-            QueryExecutionId=query_execution_id
-        )
-        
-        status = response['QueryExecution']['Status']['State']
-        
-        if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            return status
-        
-        print(f"Query status: {status} (attempt {attempt + 1}/{max_attempts})")
-        time.sleep(2)
-        attempt += 1
+    target = target or get_local_target()
+    
+    response = target['athena'].get_query_execution(
+        QueryExecutionId=query_execution_id
+    )
+    
+    return response['QueryExecution']['Status']['State']
+
+
+def get_query_runtime(query_execution_id, target=None):
+    """Get how long (seconds) an Athena query has been running"""
+    
+    target = target or get_local_target()
+    
+    response = target['athena'].get_query_execution(
+        QueryExecutionId=query_execution_id
+    )
+    
+    query_execution = response['QueryExecution']
+    runtime = query_execution.get('Statistics', {}).get('TotalExecutionTimeInMillis', 0) / 1000.0
+    
+    # Statistics can lag behind for running queries, so also use the submission time
+    submitted = query_execution['Status'].get('SubmissionDateTime')
+    if submitted:
+        runtime = max(runtime, time.time() - submitted.timestamp())
     
-    raise Exception(f"Query did not complete within {max_attempts * 2} seconds")
+    return runtime
 
 
-def get_query_results(query_execution_id):
+def get_query_results(query_execution_id, target=None):
     """Get results from Athena query"""
     
+    target = target or get_local_target()
     results = []
     
     # Get query results from S3
-    response = athena_client.get_query_results(
+    response = target['athena'].get_query_results(
         QueryExecutionId=query_execution_id,
         MaxResults=1000
     )
@@ -446,7 +1384,7 @@ def get_query_results(query_execution_id):
     
     # Handle pagination if needed
     while 'NextToken' in response:
-        response = athena_client.get_query_results(
+        response = target['athena'].get_query_results(
             QueryExecutionId=query_execution_id,
             MaxResults=1000,
             NextToken=response['NextToken']
@@ -25,6 +25,90 @@ resource "aws_secretsmanager_secret_version" "datahub_api" {
   })
 }
 
+# S3 Bucket for the NAT Gateway cost history store
+# Kept separate from the Athena results bucket, whose lifecycle rule expires
+# every object after 7 days.
+resource "aws_s3_bucket" "history" {
+  bucket = "${var.cluster_name}-nat-cost-history-${data.aws_caller_identity.current.account_id}"
+
+  tags = {
+    Name = "${var.cluster_name}-nat-cost-history"
+  }
+}
+
+# Block public access to history bucket
+resource "aws_s3_bucket_public_access_block" "history" {
+  bucket = aws_s3_bucket.history.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+# Enable versioning so earlier copies of the history store can be recovered
+resource "aws_s3_bucket_versioning" "history" {
+  bucket = aws_s3_bucket.history.id
+
+  versioning_configuration {
+    status = "Enabled"
+  }
+}
+
+# Enable server-side encryption on history bucket
+resource "aws_s3_bucket_server_side_encryption_configuration" "history" {
+  bucket = aws_s3_bucket.history.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "AES256"
+    }
+  }
+}
+
+# Lifecycle policy to clean up old versions of the history store
+resource "aws_s3_bucket_lifecycle_configuration" "history" {
+  bucket = aws_s3_bucket.history.id
+
+  rule {
+    id     = "expire-old-history-versions"
+    status = "Enabled"
+
+    filter {}
+
+    noncurrent_version_expiration {
+      noncurrent_days = var.history_version_retention_days
+    }
+  }
+}
+
+locals {
+  # Fan-out targets in the format read by the Lambda
+  fanout_targets = [
+    for target in var.fanout_targets : {
+      name          = target.name
+      roleArn       = target.role_arn
+      externalId    = target.external_id
+      region        = target.region
+      workgroup     = target.workgroup
+      database      = target.database
+      resultsBucket = target.results_bucket
+    }
+  ]
+
+  fanout_role_arns = distinct(compact([for target in var.fanout_targets : target.role_arn]))
+}
+
+# Fan-out target list, read by the Lambda from the history bucket at every
+# invocation. A list of dozens of accounts does not fit in the Lambda's
+# environment variables, which are limited to 4 KB in total.
+resource "aws_s3_object" "fanout_targets" {
+  bucket       = aws_s3_bucket.history.id
+  key          = "config/fanout_targets.json"
+  content      = jsonencode(local.fanout_targets)
+  content_type = "application/json"
+}
+
 # IAM Role for Lambda
 resource "aws_iam_role" "lambda_role" {
   name = "${var.cluster_name}-athena-query-lambda-role"
@@ -54,7 +138,7 @@ resource "aws_iam_role_policy" "lambda_policy" {
 
   policy = jsonencode({
     Version = "2012-10-17"
-    Statement = [
+    Statement = concat([
       {
         Sid    = "AthenaQueryExecution"
         Effect = "Allow"
@@ -72,6 +156,7 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Action = [
           "s3:GetObject",
           "s3:PutObject",
+          "s3:DeleteObject",
           "s3:ListBucket",
           "s3:GetBucketVersioning",
           "s3:PutBucketVersioning"
@@ -85,6 +170,19 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "arn:aws:s3:::nat-gateway-analysis-vpc-flow-logs-381492072749/*"
         ]
       },
+      {
+        Sid    = "HistoryBucket"
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.history.arn,
+          "${aws_s3_bucket.history.arn}/*"
+        ]
+      },
       {
         Sid    = "AthenaResultsBucketLocation"
         Effect = "Allow"
@@ -114,6 +212,13 @@ resource "aws_iam_role_policy" "lambda_policy" {
         ]
         Resource = "*"
       },
+      {
+        Sid    = "ResumeSelfInvoke"
+        Effect = "Allow"
+        Action = "lambda:InvokeFunction"
+        # Built from the name to avoid a cycle with aws_lambda_function.athena_query
+        Resource = "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.cluster_name}-athena-query"
+      },
       {
         Sid    = "SecretsManagerAccess"
         Effect = "Allow"
@@ -123,7 +228,14 @@ resource "aws_iam_role_policy" "lambda_policy" {
         ]
         Resource = aws_secretsmanager_secret.datahub_api.arn
       }
-    ]
+    ], [
+      for role_arns in [local.fanout_role_arns] : {
+        Sid      = "FanoutAssumeRole"
+        Effect   = "Allow"
+        Action   = "sts:AssumeRole"
+        Resource = role_arns
+      } if length(role_arns) > 0
+    ])
   })
 }
 
@@ -144,11 +256,19 @@ resource "aws_lambda_function" "athena_query" {
       ATHENA_DATABASE              = var.athena_database
       ATHENA_WORKGROUP             = var.athena_workgroup
       ATHENA_RESULTS_BUCKET        = var.athena_results_bucket
-      PUBLIC_IP_QUERY              = var.public_ip_query
-      PRIVATE_IP_QUERY             = var.private_ip_query
-      INGRESS_PRIVATE_IP_QUERY     = var.ingress_private_ip_query
-      EGRESS_PUBLIC_IP_QUERY       = var.egress_public_ip_query
       DATAHUB_SECRET_NAME          = aws_secretsmanager_secret.datahub_api.name
+      HISTORY_BUCKET               = aws_s3_bucket.history.id
+      HISTORY_KEY                  = var.history_key
+      POST_QUERY_RESERVE_SECONDS   = var.post_query_reserve_seconds
+      MAX_QUERY_RUNTIME_SECONDS    = coalesce(var.max_query_runtime_seconds, 1800 - var.lambda_timeout)
+      MAX_QUERY_RESTARTS           = var.max_query_restarts
+      RESUME_SELF_INVOKE           = tostring(var.resume_self_invoke)
+      MAX_RESUME_INVOCATIONS       = var.max_resume_invocations
+      APPROXIMATE_MODE             = tostring(var.approximate_mode)
+      APPROXIMATE_SAMPLE_HOURS     = var.approximate_sample_hours
+      FANOUT_TARGETS_BUCKET        = aws_s3_object.fanout_targets.bucket
+      FANOUT_TARGETS_KEY           = aws_s3_object.fanout_targets.key
+      FANOUT_MAX_WORKERS           = var.fanout_max_workers
     }
   }
 
@@ -156,6 +276,16 @@ resource "aws_lambda_function" "athena_query" {
     Name = "${var.cluster_name}-athena-query"
   }
 
+  lifecycle {
+    # Athena workgroups belong to one region, so the Lambda's own workgroup
+    # and results bucket cannot be used in another region. Variable
+    # validation cannot see the deployment region, hence a precondition.
+    precondition {
+      condition     = alltrue([for target in var.fanout_targets : target.region == data.aws_region.current.name || (target.workgroup != null && target.results_bucket != null)])
+      error_message = "fanout_targets in a region other than the Lambda's must set workgroup and results_bucket."
+    }
+  }
+
   depends_on = [aws_iam_role_policy.lambda_policy]
 }
 
@@ -172,11 +302,30 @@ data "archive_file" "lambda_zip" {
 resource "null_resource" "lambda_build" {
   provisioner "local-exec" {
     command = "bash ${path.module}/build_lambda.sh"
+
+    # The queries are packaged as files; Lambda environment variables are
+    # limited to 4 KB in total
+    environment = {
+      PUBLIC_IP_QUERY          = var.public_ip_query
+      PRIVATE_IP_QUERY         = var.private_ip_query
+      INGRESS_PRIVATE_IP_QUERY = var.ingress_private_ip_query
+      EGRESS_PUBLIC_IP_QUERY   = var.egress_public_ip_query
+      GATEWAY_TOTALS_QUERY     = var.gateway_totals_query
+    }
   }
   
   triggers = {
     lambda_function = filemd5("${path.module}/lambda_function.py")
+    history_store   = filemd5("${path.module}/history_store.py")
+    approximate     = filemd5("${path.module}/approximate.py")
     requirements    = filemd5("${path.module}/requirements.txt")
+    queries         = md5(join("\n", [
+      var.public_ip_query,
+      var.private_ip_query,
+      var.ingress_private_ip_query,
+      var.egress_public_ip_query,
+      var.gateway_totals_query
+    ]))
   }
 }
 
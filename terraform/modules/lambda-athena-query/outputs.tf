@@ -27,3 +27,13 @@ output "datahub_secret_name" {
   description = "Name of the DataHub API credentials secret"
   value       = aws_secretsmanager_secret.datahub_api.name
 }
+
+output "history_bucket" {
+  description = "S3 bucket holding the NAT Gateway cost history store"
+  value       = aws_s3_bucket.history.id
+}
+
+output "history_key" {
+  description = "S3 object key of the NAT Gateway cost history store"
+  value       = var.history_key
+}
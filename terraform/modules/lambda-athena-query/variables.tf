@@ -30,6 +30,53 @@ variable "lambda_memory" {
   default     = 256
 }
 
+variable "post_query_reserve_seconds" {
+  description = "Seconds of the Lambda timeout reserved for the history and DoitHub phases; queries still running past this point are stopped and resumed on the next invocation"
+  type        = number
+  default     = 60
+}
+
+variable "max_query_runtime_seconds" {
+  description = "Queries still running at the deadline are left running for the next invocation unless they have run longer than this; those are stopped (default: Athena's 1800s DML timeout minus lambda_timeout)"
+  type        = number
+  default     = null
+}
+
+variable "max_query_restarts" {
+  description = "Restarts of a failed or cancelled query before the run gives up"
+  type        = number
+  default     = 2
+}
+
+variable "resume_self_invoke" {
+  description = "Invoke the Lambda again asynchronously when it stops early, so it resumes from its checkpoint"
+  type        = bool
+  default     = true
+}
+
+variable "max_resume_invocations" {
+  description = "Maximum asynchronous self-invocations used to resume one checkpoint"
+  type        = number
+  default     = 5
+}
+
+variable "approximate_mode" {
+  description = "Run in approximate mode by default (sampled hour partitions, estimates with confidence intervals)"
+  type        = bool
+  default     = false
+}
+
+variable "approximate_sample_hours" {
+  description = "Number of hour partitions (2-24) scanned per day in approximate mode"
+  type        = number
+  default     = 6
+
+  validation {
+    condition     = var.approximate_sample_hours >= 2 && var.approximate_sample_hours <= 24
+    error_message = "approximate_sample_hours must be between 2 and 24."
+  }
+}
+
 variable "public_ip_query" {
   description = "Athena query for public IP traffic analysis"
   type        = string
@@ -50,6 +97,11 @@ variable "egress_public_ip_query" {
   type        = string
 }
 
+variable "gateway_totals_query" {
+  description = "Athena query for untruncated daily NAT gateway totals (history store only)"
+  type        = string
+}
+
 variable "datahub_api_url" {
   description = "DataHub API URL"
   type        = string
@@ -67,3 +119,43 @@ variable "datahub_customer_context" {
   type        = string
   sensitive   = true
 }
+
+variable "history_key" {
+  description = "S3 object key of the NAT Gateway cost history store"
+  type        = string
+  default     = "history/nat_cost_history.sqlite"
+}
+
+variable "history_version_retention_days" {
+  description = "Days to keep noncurrent versions of the history store"
+  type        = number
+  default     = 30
+}
+
+variable "fanout_targets" {
+  description = "Fan-out targets (account role, region, Athena workgroup/database/results bucket) queried in parallel by the Lambda; empty queries only this account"
+  type = list(object({
+    name           = optional(string)
+    role_arn       = optional(string)
+    external_id    = optional(string)
+    region         = string
+    workgroup      = optional(string)
+    database       = optional(string)
+    results_bucket = optional(string)
+  }))
+  default = []
+
+  validation {
+    condition     = alltrue([for target in var.fanout_targets : target.role_arn == null || (target.workgroup != null && target.results_bucket != null)])
+    error_message = "fanout_targets with a role_arn must also set workgroup and results_bucket in the target account."
+  }
+
+  # Targets in another region of this account need them too; that rule is a
+  # precondition on the Lambda function, which knows the deployment region
+}
+
+variable "fanout_max_workers" {
+  description = "Maximum number of fan-out targets queried at the same time"
+  type        = number
+  default     = 8
+}
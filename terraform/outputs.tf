@@ -120,3 +120,8 @@ output "lambda_cloudwatch_logs" {
   description = "CloudWatch log group for Lambda function"
   value       = module.lambda_athena_query.cloudwatch_log_group
 }
+
+output "nat_cost_history_bucket" {
+  description = "S3 bucket holding the NAT Gateway cost history store"
+  value       = module.lambda_athena_query.history_bucket
+}
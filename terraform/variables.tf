@@ -69,3 +69,31 @@ variable "datahub_customer_context" {
   type        = string
   sensitive   = true
 }
+
+variable "fanout_targets" {
+  description = "Fan-out targets (account role, region, Athena workgroup/database/results bucket) queried in parallel by the Lambda; empty queries only this account"
+  type = list(object({
+    name           = optional(string)
+    role_arn       = optional(string)
+    external_id    = optional(string)
+    region         = string
+    workgroup      = optional(string)
+    database       = optional(string)
+    results_bucket = optional(string)
+  }))
+  default = []
+
+  validation {
+    condition     = alltrue([for target in var.fanout_targets : target.role_arn == null || (target.workgroup != null && target.results_bucket != null)])
+    error_message = "fanout_targets with a role_arn must also set workgroup and results_bucket in the target account."
+  }
+
+  # Targets in another region of this account need them too; that rule is a
+  # precondition on the Lambda function, which knows the deployment region
+}
+
+variable "fanout_max_workers" {
+  description = "Maximum number of fan-out targets queried at the same time"
+  type        = number
+  default     = 8
+}